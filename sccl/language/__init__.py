@@ -3,7 +3,6 @@
 
 from dataclasses import dataclass
 from enum import Enum
-import functools
 from sccl.language.ir import *
 from sccl.language.passes import *
 from sccl.language.tb_assignment import *
@@ -13,6 +12,19 @@ from sccl.language.rank_dag import *
 import sccl.collectives as collectives
 
 
+# Slicing doesn't raise on out of bounds ranges, so check the range explicitly
+def _get_chunks(buf, index, size):
+    chunks = buf[index:index+size]
+    assert index >= 0 and len(chunks) == size, f'Chunks {index} to {index+size-1} are out of bounds'
+    return chunks
+
+# Input and output buffers have a fixed size, scratch buffers (BufferSlice) grow when written past their end
+def _set_chunks(buf, index, chunks):
+    assert index >= 0 and (type(buf) is BufferSlice or index + len(chunks) <= len(buf)), \
+        f'Chunks {index} to {index+len(chunks)-1} are out of bounds'
+    buf[index:index+len(chunks)] = chunks
+
+
 _current_program = None
 def _curr():
     global _current_program
@@ -40,6 +52,8 @@ class SCCLProgram:
         self.chunk_dag = ChunkDAG()
         self.buffers = collective.init_buffers()
         self.rank_dag = RankDAG(self.num_ranks, self.buffers)
+        self._ref_cache = {} # (rank, buffer, index, size) -> Ref returned by get_ref
+        self._buffer_index_cache = {} # (rank, buffer, index) -> buffer and index given by the collective
         for r in range(self.num_ranks):
             for index, chunk in enumerate(self.buffers[r][Buffer.input]):
                 ref = self.get_ref(r, Buffer.input, index, 1)
@@ -58,32 +72,43 @@ class SCCLProgram:
         _current_program = None
 
     def add_send(self, src, src_buffer, src_index, dst, dst_buffer, dst_index, size):
-        src_buffer, src_index = self.collective.get_buffer_index(src, src_buffer, src_index)
-        dst_buffer, dst_index = self.collective.get_buffer_index(dst, dst_buffer, dst_index)
+        src_buffer, src_index = self.get_buffer_index(src, src_buffer, src_index)
+        dst_buffer, dst_index = self.get_buffer_index(dst, dst_buffer, dst_index)
         sb = self.buffers[src][src_buffer]
         db = self.buffers[dst][dst_buffer]
-        for i in range(size):
-            db[dst_index + i] = sb[src_index + i]
+        _set_chunks(db, dst_index, _get_chunks(sb, src_index, size))
 
     def add_reduce(self, src, src_buffer, src_index, dst, dst_buffer, dst_index, size):
-        src_buffer, src_index = self.collective.get_buffer_index(src, src_buffer, src_index)
-        dst_buffer, dst_index = self.collective.get_buffer_index(dst, dst_buffer, dst_index)
+        src_buffer, src_index = self.get_buffer_index(src, src_buffer, src_index)
+        dst_buffer, dst_index = self.get_buffer_index(dst, dst_buffer, dst_index)
         sb = self.buffers[src][src_buffer]
         db = self.buffers[dst][dst_buffer]
-        for i in range(size):
-            reduce_chunk = db[dst_index + i]
-            sent_chunk = sb[src_index + i]
-            db[dst_index + i] = reduce_chunk.reduce(sent_chunk)
+        sent_chunks = _get_chunks(sb, src_index, size)
+        reduce_chunks = _get_chunks(db, dst_index, size)
+        _set_chunks(db, dst_index, [reduce_chunk.reduce(sent_chunk) for reduce_chunk, sent_chunk in zip(reduce_chunks, sent_chunks)])
+
+    # The collective's mapping of buffers and indices only depends on its arguments, so it is computed
+    # once per location
+    def get_buffer_index(self, rank, buffer, index):
+        key = (rank, buffer, index)
+        buffer_index = self._buffer_index_cache.get(key)
+        if buffer_index is None:
+            buffer_index = self.collective.get_buffer_index(rank, buffer, index)
+            self._buffer_index_cache[key] = buffer_index
+        return buffer_index
 
     def get_ref(self, rank, buffer, index, size):
-        buffer, index = self.collective.get_buffer_index(rank, buffer, index)
-        return Ref(rank, buffer, index, size, self)
+        buffer, index = self.get_buffer_index(rank, buffer, index)
+        # Refs are never modified, so the same location can share a single Ref
+        key = (rank, buffer, index, size)
+        ref = self._ref_cache.get(key)
+        if ref is None:
+            ref = Ref(rank, buffer, index, size, self)
+            self._ref_cache[key] = ref
+        return ref
 
     def get_chunks(self, rank, buffer, index, size=1):
-        chunks = [None] * size
-        for i in range(index, index+size):
-            chunks[i-index] = self.buffers[rank][buffer][i]
-        return chunks
+        return _get_chunks(self.buffers[rank][buffer], index, size)
 
     def check_buffer_exists(self, rank, name):
         if name not in self.buffers[rank]:
@@ -100,6 +125,7 @@ class SCCLProgram:
         self.chunk_dag.lower_rank_dag(self.rank_dag)
        
         self.rank_dag.optimize()
+        self.rank_dag.convert_set_list()
         if self.threadblock_policy == ThreadblockPolicy.manual:
             manual_assign_tbs(self.rank_dag)
         else:
@@ -141,8 +167,12 @@ def Check():
 
 @dataclass
 class Ref(ChunkRef):
+    __slots__ = ('prog', '_buf')
     prog: SCCLProgram
 
+    def __post_init__(self):
+        self._buf = None # Buffer this Ref points into, looked up on first use
+
     def __repr__(self):
         return f'Ref(Buffer:{self.buffer}, Index:{self.index}, Size:{self.size}, Rank:{self.rank})'
 
@@ -150,29 +180,23 @@ class Ref(ChunkRef):
         return self.index + self.size
 
     def _get_chunk(self, index):
-        return self.prog.buffers[self.rank][self.buffer][index]
+        # Buffers are never replaced once created so the lookup can be cached
+        if self._buf is None:
+            self._buf = self.prog.buffers[self.rank][self.buffer]
+        return self._buf[index]
 
     def split(self, num):
         assert (self.size % num == 0), f'Trying to split a chunk of {self.size} elements into {num} parts'
-        chunks = [None] * num
         size = self.size // num
-        for i in range(num):
-            index = self.index + i * size
-            chunks[i] = self.prog.get_ref(self.rank, self.buffer, index, size)
-        return chunks
+        # self.buffer and self.index are already resolved so there is no need to go through get_ref
+        return [Ref(self.rank, self.buffer, self.index + i * size, size, self.prog) for i in range(num)]
 
     def group(self, other):
         assert (self.rank == other.rank), f'Trying to concatenate chunks on ranks {self.rank} and {other.rank}'
         assert (self.buffer == other.buffer), f'Trying to concatenate chunks in {self.buffer} and {other.buffer}'
-        if self.index < other.index:
-            first = self
-            second = other
-        else:
-            first = other
-            second = self
-
-        end = max(first._end(), second._end())
-        return Ref(self.rank, self.buffer, first.index, end - first.index, self.prog)
+        index = min(self.index, other.index)
+        end = max(self._end(), other._end())
+        return Ref(self.rank, self.buffer, index, end - index, self.prog)
         
 
     def send(self, dst, buffer=None, index=-1, sendtb=-1, recvtb=-1, ch=-1):
@@ -186,16 +210,14 @@ class Ref(ChunkRef):
             index = self.prog.buffers[dst][buffer].instance_size()
 
         # Some inplace collectives have custom logic for buffers and index (ReduceScatter, AllGather)
-        buffer, index = self.prog.collective.get_buffer_index(self.rank, buffer, index)
+        buffer, index = self.prog.get_buffer_index(self.rank, buffer, index)
 
         # Direct send
         assert (self.prog.topo.link(self.rank, dst) or dst == self.rank), f'No link from {self.rank} to {dst}'
-        dst_chunkref = self.prog.get_ref(dst, buffer, index, self.size)
+        dst_chunkref = Ref(dst, buffer, index, self.size, self.prog)
 
         self.prog.add_send(self.rank, self.buffer, self.index, dst, buffer, index, self.size)
-
-        chunks = self.prog.get_chunks(self.rank, self.buffer, self.index, self.size)
-        self.prog.chunk_dag.add_send(chunks, self, dst_chunkref, sendtb, recvtb, ch)
+        self.prog.chunk_dag.add_send(self, dst_chunkref, sendtb, recvtb, ch)
 
         return dst_chunkref
 
@@ -203,19 +225,14 @@ class Ref(ChunkRef):
         self.prog.check_buffer_exists(dst, buffer)
 
         # Some inplace collectives have custom logic for buffers and index (ReduceScatter, AllGather)
-        buffer, index = self.prog.collective.get_buffer_index(self.rank, buffer, index)
+        buffer, index = self.prog.get_buffer_index(self.rank, buffer, index)
 
         # Receive reduce copy
         assert (self.prog.topo.link(self.rank, dst) or dst == self.rank), f'No link from {self.rank} to {dst}'
-        dst_chunkref = self.prog.get_ref(dst, buffer, index, self.size)
-
-        chunks1 = self.prog.get_chunks(self.rank, self.buffer, self.index, self.size)
-        chunks2 = self.prog.get_chunks(dst, buffer, index, self.size)
+        dst_chunkref = Ref(dst, buffer, index, self.size, self.prog)
 
         self.prog.add_reduce(self.rank, self.buffer, self.index, dst, buffer, index, self.size)
-
-        reduce_chunks = self.prog.get_chunks(dst, buffer, index, self.size)
-        self.prog.chunk_dag.add_reduce(chunks1, chunks2, reduce_chunks, self, dst_chunkref, sendtb, recvtb, ch)
+        self.prog.chunk_dag.add_reduce(self, dst_chunkref, sendtb, recvtb, ch)
         return dst_chunkref
 
     def get_origin_index(self, index=0):
@@ -234,20 +251,24 @@ class Ref(ChunkRef):
         print(self._get_chunk(index + self.index)) 
 
 
-@dataclass
+# Not a dataclass so that it can use __slots__, a ChunkOp is created for every send and reduce
 class ChunkOp():
-    inst: ChunkInstruction
-    src: Ref # Ref Chunk acted on
-    dst: Ref # Ref Chunk created
-    sendtb: int = -1# For lowering to RankInstructions
-    recvtb: int = -1#  For lowering to RankInstructions
-    ch: int = -1 # For lowering to RankInstructions
-    steps_from_start:int  = -1
-    steps_to_end: int = -1 
-    prev: list = field(default_factory=list) # Previous ChunkOps
-    next: list = field(default_factory=list) # Next ChunkOps
-    visited = False
-    num = -1
+    __slots__ = ('inst', 'src', 'dst', 'sendtb', 'recvtb', 'ch', 'steps_from_start', 'steps_to_end', 'prev', 'next')
+
+    def __init__(self, inst, src, dst, sendtb=-1, recvtb=-1, ch=-1, steps_from_start=-1, steps_to_end=-1, prev=None, next=None):
+        self.inst = inst
+        self.src = src # Ref Chunk acted on
+        self.dst = dst # Ref Chunk created
+        self.sendtb = sendtb # For lowering to RankInstructions
+        self.recvtb = recvtb #  For lowering to RankInstructions
+        self.ch = ch # For lowering to RankInstructions
+        self.steps_from_start = steps_from_start
+        self.steps_to_end = steps_to_end
+        self.prev = [] if prev is None else prev # Previous ChunkOps
+        self.next = [] if next is None else next # Next ChunkOps
+
+    def __eq__(self, other):
+        return self is other
 
     def __repr__(self):
         return f'ChunkOp({self.inst} {self.dst.rank} {self.dst.buffer} {self.dst.index})'
@@ -258,87 +279,74 @@ class ChunkOp():
     def __hash__(self):
         return hash((self.inst, self.dst.rank, self.dst.index, self.dst.buffer)) # TODO 
 
-def same_slot(ref1, ref2):
-    return ref1.rank == ref2.rank and ref1.buffer == ref2.buffer and ref1.index == ref2.index
-
-# Returns if there is overlap between the refs
-def overlap_refs(ref1, ref2):
-    same_location = ref1.rank == ref2.rank and ref1.buffer == ref2.buffer
-    contained1 = ref1.index >= ref2.index and (ref1.index + ref1.size) <= (ref2.index + ref2.size)
-    contained2 = ref2.index >= ref1.index and (ref2.index + ref2.size) <= (ref1.index + ref1.size)
-    return same_location and (contained1 or contained2)
-
 class ChunkDAG:
 
     def __init__(self):
-        self.chunks = []
         self.chunk_paths = {} # chunk -> ChunkOp. Stores the entry point to where every chunk is created
-        self.max_hops = -1
+        self.last_ops = {} # slot (rank, buffer, index) -> last ChunkOp that wrote to the slot
 
     # Initialize the ChunkDAG with starting chunks
     def init_chunk(self, chunk, ref):
         op = ChunkOp(ChunkInstruction.start, None, ref, steps_from_start=-1)
-        self.chunks.append(chunk)
         self.chunk_paths[chunk] = op
-
-    def _find_prev_op_for_chunk(self, chunk, ref):
-        prev_op = None
-        frontier = [self.chunk_paths[chunk]]
-        while len(frontier) > 0:
-            current_op = frontier[0]
-            if overlap_refs(ref, current_op.dst):
-                prev_op = current_op
-            frontier = frontier[1:] + current_op.next
-        return prev_op
-
-    def add_send(self, chunks, src, dst, sendtb, recvtb, ch):
+        self._set_last_op(ref, op)
+
+    # Record op as the last operation that wrote to every slot in ref
+    def _set_last_op(self, ref, op):
+        for i in range(ref.index, ref.index + ref.size):
+            self.last_ops[(ref.rank, ref.buffer, i)] = op
+
+    # Returns the last operations that wrote to the slots in ref
+    # Contiguous slots are usually written by the same op so duplicates are removed
+    def _find_prev_ops(self, ref):
+        last_ops = self.last_ops
+        rank, buffer = ref.rank, ref.buffer
+        if ref.size == 1:
+            return [last_ops[(rank, buffer, ref.index)]]
+        return list(dict.fromkeys(last_ops[(rank, buffer, i)] for i in range(ref.index, ref.index + ref.size)))
+
+    def add_send(self, src, dst, sendtb, recvtb, ch):
         # Find the previous operation for these chunks
-        prev_ops = []
-        steps_from_start = 0
-        for chunk in chunks:
-            prev_op = self._find_prev_op_for_chunk(chunk, src)
-            steps_from_start = max(steps_from_start, prev_op.steps_from_start)
-            prev_ops.append(prev_op)
+        prev_ops = self._find_prev_ops(src)
+        steps_from_start = max(0, max(prev_op.steps_from_start for prev_op in prev_ops))
         op = ChunkOp(ChunkInstruction.send, src, dst, sendtb, recvtb, ch, steps_from_start+1)
         
         for prev_op in prev_ops:
             prev_op.next.append(op)
         op.prev = prev_ops
+        self._set_last_op(dst, op)
 
-    def add_reduce(self, chunks1, chunks2, reduce_chunks, src, dst, sendtb, recvtb, ch):
-        # self.chunks.append(reduce_chunks)
-        prev_ops = []
-        steps_from_start = 0
+    def add_reduce(self, src, dst, sendtb, recvtb, ch):
         # Find the previous operations that reduce builds off
-        for chunk1, chunk2 in zip(chunks1, chunks2):
-            prev_op_src = self._find_prev_op_for_chunk(chunk1, src)
-            prev_op_dst = self._find_prev_op_for_chunk(chunk2, dst)
-            steps_from_start = max(prev_op_src.steps_from_start, prev_op_dst.steps_from_start, steps_from_start)
-            prev_ops.append(prev_op_src)
-            prev_ops.append(prev_op_dst)
-            
+        # Ops are kept in slot order, with the source op before the destination op of each slot
+        last_ops = self.last_ops
+        prev_ops = list(dict.fromkeys(last_ops[(ref.rank, ref.buffer, ref.index + i)] for i in range(src.size) for ref in (src, dst)))
+        steps_from_start = max(0, max(prev_op.steps_from_start for prev_op in prev_ops))
         op = ChunkOp(ChunkInstruction.reduce, src, dst, sendtb, recvtb, ch, steps_from_start+1)
 
         for prev_op in prev_ops:
             prev_op.next.append(op)
             op.prev.append(prev_op)
 
-        # Reduce operations create new chunks, so keep a pointer to a new chunk
-        for rc in reduce_chunks:
-            self.chunk_paths[rc] = op
+        # Reduce operations create new chunks in the destination slots
+        self._set_last_op(dst, op)
 
     def _complete_metadata(self):
-        def dfs(op):
-            if len(op.next) == 0:
-                op.steps_to_end = 0
-            else:
-                for o in op.next:
-                    dfs(o)
-                op.steps_to_end = functools.reduce(lambda cur, x: max(cur, x.steps_to_end+1), op.next, 0)
-
-        for chunk, op in self.chunk_paths.items():
-            if op.inst == ChunkInstruction.start:
-                dfs(op)
+        # Iterative post-order DFS, an op's steps_to_end is computed once all of its next ops are done
+        for chunk, start_op in self.chunk_paths.items():
+            if start_op.inst == ChunkInstruction.start:
+                stack = [start_op]
+                while len(stack) > 0:
+                    op = stack[-1]
+                    if op.steps_to_end != -1:
+                        stack.pop()
+                        continue
+                    pending = [o for o in op.next if o.steps_to_end == -1]
+                    if len(pending) > 0:
+                        stack.extend(pending)
+                    else:
+                        op.steps_to_end = max((o.steps_to_end + 1 for o in op.next), default=0)
+                        stack.pop()
             
     def lower_rank_dag(self, rank_dag):
         frontier = []
@@ -379,4 +387,3 @@ class ChunkDAG:
                 for o in op.next:
                     heapq.heappush(frontier, o)
                 visited.add(op)
-        rank_dag.convert_set_list() # Pre-emptively convert sets to lists
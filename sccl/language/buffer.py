@@ -3,6 +3,8 @@
 
 # Scratch buffer slice with manual indexing
 class BufferSlice:
+    __slots__ = ('name', 'buf', 'offset', 'chunks')
+
     def __init__(self, buf, name):
         self.name = name
         self.buf = buf
@@ -27,11 +29,9 @@ class BufferSlice:
         return self.chunks[index]
     
     def __setitem__(self, index, value):
+        # Grow the buffer to fit index, leaving any skipped slots empty
+        end = index.stop if type(index) is slice else index + 1
         current_size = len(self.chunks)
-        while index > current_size:
-            self.chunks.append(None)
-            current_size = len(self.chunks)
-        if index == current_size:
-            self.chunks.append(value)
-        else:
-            self.chunks[index] = value
\ No newline at end of file
+        if end > current_size:
+            self.chunks.extend([None] * (end - current_size))
+        self.chunks[index] = value
\ No newline at end of file
@@ -2,15 +2,21 @@
 # Licensed under the MIT License.
 
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from sccl.language.ir import *
 
-@dataclass
+# Not a dataclass so that it can use __slots__, as programs create a Chunk for every input slot
 class Chunk:
-    origin_rank: int # Rank the chunk initially started at
-    origin_index: int # Index the chunk initially started at
-    dst_rank: int = -1
-    dst_index: int = -1
+    __slots__ = ('origin_rank', 'origin_index', 'dst_rank', 'dst_index')
+
+    def __init__(self, origin_rank, origin_index, dst_rank=-1, dst_index=-1):
+        self.origin_rank = origin_rank # Rank the chunk initially started at
+        self.origin_index = origin_index # Index the chunk initially started at
+        self.dst_rank = dst_rank
+        self.dst_index = dst_index
+
+    def __repr__(self):
+        return f'Chunk(origin_rank={self.origin_rank}, origin_index={self.origin_index}, dst_rank={self.dst_rank}, dst_index={self.dst_index})'
 
     def reduce(self, chunk):
         if type(chunk) is ReduceChunk:
@@ -35,6 +41,7 @@ class Chunk:
 @dataclass
 class ReduceChunk:
     chunks: list # List of chunks reduced
+    _key: tuple = field(default=None, init=False, repr=False) # Sorted chunks, computed on first comparison
 
     def reduce(self, chunk):
         if type(chunk) is ReduceChunk:
@@ -45,15 +52,16 @@ class ReduceChunk:
             assert True, "Trying to reduce with chunk of None"
         return ReduceChunk(chunks)
 
-    def sort(self):
-        self.chunks.sort()
+    # Reduction is commutative so the order chunks were reduced in doesn't matter
+    def key(self):
+        if self._key is None:
+            self._key = tuple(sorted(self.chunks))
+        return self._key
 
     def __hash__(self):
-        return hash(tuple(self.chunks))
+        return hash(self.key())
 
     # Two reduce chunks are equal if they contain the same list of
     # chunks being reduced
     def __eq__(self, other):
-        self.sort()
-        other.sort()
-        return self.chunks == other.chunks
+        return type(other) is ReduceChunk and self.key() == other.key()
@@ -2,6 +2,11 @@ from dataclasses import dataclass, field
 from sccl.language.ir import Buffer
 from sccl.language import *
 
+# Returns the (origin_rank, origin_index) of every chunk in buffer
+def _chunk_origins(buffer):
+    return [None if chunk is None else (chunk.origin_rank, chunk.origin_index) for chunk in buffer]
+
+
 class Collective():
     def __init__(self, num_ranks, chunk_factor, inplace):
         self.num_ranks = num_ranks
@@ -27,13 +32,15 @@ class AllToAll(Collective):
 
     def init_buffers(self):
         chunks_per_node = self.num_ranks * self.chunk_factor
+        # Destination rank and index (minus the sender's offset) are the same for every rank
+        dst_ranks = [index // self.chunk_factor for index in range(chunks_per_node)]
+        dst_indices = [index % self.chunk_factor for index in range(chunks_per_node)]
         rank_buffers = []
         for r in range(self.num_ranks):
-            input_buffer = [None] * chunks_per_node
+            offset = r * self.chunk_factor
+            input_buffer = [Chunk(r, index, dst_rank, dst_index + offset)
+                            for index, (dst_rank, dst_index) in enumerate(zip(dst_ranks, dst_indices))]
             output_buffer = [None] * chunks_per_node
-            for index in range(chunks_per_node):
-                chunk = Chunk(r, index, index//self.chunk_factor, index % self.chunk_factor + r*self.chunk_factor)
-                input_buffer[index] = chunk
             buffers = {Buffer.input : input_buffer, 
                     Buffer.output : output_buffer}
             rank_buffers.append(buffers)
@@ -45,6 +52,10 @@ class AllToAll(Collective):
         correct = True
         for r in range(self.num_ranks):
             output = prog.buffers[r][Buffer.output]
+            expected = [(i, ch + r * self.chunk_factor) for i in range(self.num_ranks) for ch in range(self.chunk_factor)]
+            if _chunk_origins(output[:chunks_per_node]) == expected:
+                continue
+            # Report every incorrect chunk
             for i in range(self.num_ranks):
                 for ch in range(self.chunk_factor):
                     index = ch + i * self.chunk_factor
@@ -88,8 +99,13 @@ class AllGather(Collective):
     def check(self, prog):
         correct = True
         buf = Buffer.output
+        # Every rank ends up with all chunks in rank order
+        expected = [(i, ch) for i in range(self.num_ranks) for ch in range(self.chunk_factor)]
         for r in range(self.num_ranks):
             output = prog.buffers[r][buf]
+            if _chunk_origins(output[:len(expected)]) == expected:
+                continue
+            # Report every incorrect chunk
             for i in range(self.num_ranks):
                 for ch in range(self.chunk_factor):
                     index = i*self.chunk_factor + ch
@@ -142,11 +158,9 @@ class AllReduce(Collective):
         expected_chunks = []
         buf = Buffer.input if self.inplace else Buffer.output
 
+        # Each output chunk c is the reduction of chunk c from every rank
         for c in range(chunks_per_node):
-            chunk = ReduceChunk([])
-            for r in range(self.num_ranks):
-                chunk = chunk.reduce(Chunk(r, c))
-            expected_chunks.append(chunk)
+            expected_chunks.append(ReduceChunk([Chunk(r, c) for r in range(self.num_ranks)]))
 
         correct = True
         for r in range(self.num_ranks):
@@ -195,10 +209,7 @@ class ReduceScatter(Collective):
         expected_chunks = []
         buf = Buffer.input if self.inplace else Buffer.output
         for c in range(self.num_ranks * self.chunk_factor):
-            chunk = ReduceChunk([])
-            for r in range(self.num_ranks):
-                chunk = chunk.reduce(Chunk(r, c))
-            expected_chunks.append(chunk)
+            expected_chunks.append(ReduceChunk([Chunk(r, c) for r in range(self.num_ranks)]))
 
         correct = True
         for r in range(self.num_ranks):
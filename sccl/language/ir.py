@@ -1,10 +1,9 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from lxml import etree as ET
+from xml.sax.saxutils import escape
 from dataclasses import dataclass, field
 from enum import Enum
-from collections import defaultdict
 
 
 @dataclass
@@ -36,11 +35,16 @@ class Threadblock:
         return id(self)
 
 
+# Members are singletons compared by identity, so hash them by identity too.
+# Enum's default __hash__ is a Python level function hashing the member name,
+# which is slow for the dict and set lookups done on every op.
 class ChunkInstruction(Enum):
     start = 'start'
     reduce = 'reduce'
     send = 'send'
 
+    __hash__ = object.__hash__
+
     def __str__(self):
         return self.value
 
@@ -66,6 +70,8 @@ class Instruction(Enum):
     delete = 'd' 
     start = 'st'
 
+    __hash__ = object.__hash__
+
     def __str__(self):
         return self.value
 
@@ -75,12 +81,15 @@ class Buffer(Enum):
     output = 'o'
     scratch = 's'
 
+    __hash__ = object.__hash__
+
     def __str__(self):
         return self.value
 
 
 @dataclass
 class ChunkRef:
+    __slots__ = ('rank', 'buffer', 'index', 'size')
     rank: int
     buffer: Buffer
     index: int
@@ -90,22 +99,27 @@ class ChunkRef:
         return hash((self.rank, self.buffer, self.index, self.size))
 
 
-@dataclass
+# Not a dataclass so that it can use __slots__, as Ops are the most numerous objects in a lowered program
 class Op:
-    inst: Instruction
-    rank: int
-    src: ChunkRef
-    dst: ChunkRef
-    depends: list = field(default_factory=list)
-    step: int = -1 # Step in the TB
-    tb: int = -1 # TB this op is assigned to
-    prev: list = field(default_factory=list)
-    next: list = field(default_factory=list)
-    num: int = -1
-    chunk_step: int = -1
-    priority: int = -1
-    match: list = field(default_factory=list) # This should be another Op
-    channel: int = -1
+    __slots__ = ('inst', 'rank', 'src', 'dst', 'depends', 'step', 'tb', 'prev', 'next', 'num', 'chunk_step',
+                 'priority', 'match', 'channel')
+
+    def __init__(self, inst, rank, src, dst, depends=None, step=-1, tb=-1, prev=None, next=None, num=-1,
+                 chunk_step=-1, priority=-1, match=None, channel=-1):
+        self.inst = inst
+        self.rank = rank
+        self.src = src
+        self.dst = dst
+        self.depends = [] if depends is None else depends
+        self.step = step # Step in the TB
+        self.tb = tb # TB this op is assigned to
+        self.prev = [] if prev is None else prev
+        self.next = [] if next is None else next
+        self.num = num
+        self.chunk_step = chunk_step
+        self.priority = priority
+        self.match = [] if match is None else match # This should be another Op
+        self.channel = channel
 
     def cnt(self):
         if self.src:
@@ -118,20 +132,15 @@ class Op:
             return 0
 
     def is_send(self):
-         return self.inst == Instruction.send or \
-            self.inst == Instruction.recv_reduce_copy_send or \
-            self.inst == Instruction.recv_copy_send or \
-            self.inst == Instruction.recv_reduce_send
+        return self.inst in _send_insts
 
     def is_recv(self):
-        return  self.inst == Instruction.recv or \
-            self.inst == Instruction.recv_reduce_copy or \
-            self.inst == Instruction.recv_reduce_copy_send or \
-            self.inst == Instruction.recv_copy_send or \
-            self.inst == Instruction.recv_reduce_send
+        return self.inst in _recv_insts
 
-    def __eq__(self, other):
-        return self is other
+    # Ops are compared and hashed by identity with the C level object methods, which keeps the
+    # sets and dicts of ops used throughout lowering cheap
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
 
     def __lt__(self, other):
         # Ordering of operations
@@ -145,13 +154,16 @@ class Op:
     def __gt__(self, other):
         return not self < other
 
-    def __hash__(self):
-        return id(self)
-
     def __repr__(self):
         return f'Op({self.inst}, {self.rank}, {self.src}, {self.dst}, step:{self.step}, tb:{self.tb})'
 
 
+# Instructions that send to another GPU
+_send_insts = frozenset([Instruction.send, Instruction.recv_reduce_copy_send, Instruction.recv_copy_send,
+                         Instruction.recv_reduce_send])
+# Instructions that receive from another GPU
+_recv_insts = frozenset([Instruction.recv, Instruction.recv_reduce_copy, Instruction.recv_reduce_copy_send,
+                         Instruction.recv_copy_send, Instruction.recv_reduce_send])
 # Instructions where src is on local GPU
 _local_src_insts = {Instruction.send, Instruction.copy, Instruction.reduce}
 # Instructions where dst is on local GPU
@@ -160,154 +172,170 @@ _local_dst_insts = {Instruction.recv, Instruction.recv_copy_send, Instruction.re
                     Instruction.recv_reduce_copy_send}
 
 
-def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=True):
-    # Figure out sizes of buffers based on usage
-    buffer_sizes = defaultdict(lambda: 0)
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            for op in tb.ops:
-                if op.inst in _local_src_insts:
-                    key = (gpu.rank, op.src.buffer)
-                    buffer_sizes[key] = max(
-                        buffer_sizes[key], op.src.index + op.src.size)
-                if op.inst in _local_dst_insts:
-                    key = (gpu.rank, op.dst.buffer)
-                    buffer_sizes[key] = max(
-                        buffer_sizes[key], op.dst.index + op.dst.size)
+# Attribute values are escaped the same way lxml serializes them
+_xml_attr_entities = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+# Writes XML elements directly to a list of strings, which is much faster than building an lxml tree
+# for large programs. Elements are written in document order and ones with children must be closed with end().
+class _XmlWriter:
+    def __init__(self, pretty_print):
+        self.pretty_print = pretty_print
+        self.parts = []
+        self.depth = 0
+
+    def _indent(self):
+        if self.pretty_print:
+            if len(self.parts) > 0:
+                self.parts.append('\n')
+            self.parts.append('  ' * self.depth)
+
+    def start(self, tag, attrs, empty=False):
+        self._indent()
+        self.parts.append(f'<{tag}')
+        for key, value in attrs:
+            self.parts.append(f' {key}="{escape(str(value), _xml_attr_entities)}"')
+        if empty:
+            self.parts.append('/>')
+        else:
+            self.parts.append('>')
+            self.depth += 1
 
-    tb_id = {}
-    # Sort threadblocks in each GPU by peers and then the channel
-    # This is important as in NCCL threadblocks using the same NVLink concurrently should be close together
-    for gpu in program.gpus:
-        gpu.threadblocks = sorted(gpu.threadblocks,
-                                  key=lambda tb: (tb.send, tb.recv, tb.channel))
-        for i, tb in enumerate(gpu.threadblocks):
-            tb_id[tb] = i
+    # Appends an element whose text has already been built and escaped
+    def element(self, text):
+        self._indent()
+        self.parts.append(text)
 
-    # Filter out dependencies within the same threadblock
-    op_tb_id = {}
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            for op in tb.ops:
-                op_tb_id[op] = tb_id[tb]
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            for op in tb.ops:
-                op.depends = list(
-                    filter(lambda dep: op_tb_id[dep] != tb_id[tb], op.depends))
-    # Filter out redundant dependencies
-    # e.g. if op1 and op2 depend on op, and op1 happends before op2 
-    # then op2 does not need to explicitly depend on op
-    for gpu in program.gpus:
-        for tb in gpu.threadblocks:
-            running_depends = []
-            for op in tb.ops:
-                op.depends = list(
-                    filter(lambda dep: dep not in running_depends, op.depends))
-                running_depends = running_depends + op.depends
+    def end(self, tag):
+        self.depth -= 1
+        self._indent()
+        self.parts.append(f'</{tag}>')
 
-    # Mark all ops that have a dependence on them
-    has_dependence = set()
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=True):
+    buffer_sizes = {} # rank -> buffer -> number of chunks used
+    op_tb_id = {} # op -> index of its threadblock in the sorted threadblocks of its GPU
     for gpu in program.gpus:
-        for tb in gpu.threadblocks:
+        # Sort threadblocks in each GPU by peers and then the channel
+        # This is important as in NCCL threadblocks using the same NVLink concurrently should be close together
+        gpu.threadblocks = sorted(gpu.threadblocks,
+                                  key=lambda tb: (tb.send, tb.recv, tb.channel))
+        # Figure out sizes of buffers based on usage
+        sizes = {Buffer.input: 0, Buffer.output: 0, Buffer.scratch: 0}
+        for tbid, tb in enumerate(gpu.threadblocks):
             for op in tb.ops:
-                has_dependence.update(op.depends)
-
-    # Do some additional postprocessing of operations:
+                op_tb_id[op] = tbid
+                if op.inst in _local_src_insts:
+                    end = op.src.index + op.src.size
+                    if end > sizes.get(op.src.buffer, 0):
+                        sizes[op.src.buffer] = end
+                if op.inst in _local_dst_insts:
+                    end = op.dst.index + op.dst.size
+                    if end > sizes.get(op.dst.buffer, 0):
+                        sizes[op.dst.buffer] = end
+        buffer_sizes[gpu.rank] = sizes
+
+    # Postprocess the operations of each threadblock, needs op_tb_id of every op to be known:
+    # - Filter out dependencies within the same threadblock
+    # - Filter out redundant dependencies
+    #   e.g. if op1 and op2 depend on op, and op1 happends before op2 
+    #   then op2 does not need to explicitly depend on op
+    # - Mark all ops that have a dependence on them
     # - Expand operations with extra dependencies with no-ops
     # - Mark the index of each operation taking any extra no-ops into account
+    has_dependence = set()
     op_idx = {}
     for gpu in program.gpus:
-        for tb in gpu.threadblocks:
+        for tbid, tb in enumerate(gpu.threadblocks):
+            running_depends = set()
             new_ops = []
+            idx = 0
             for op in tb.ops:
+                op.depends = [dep for dep in op.depends
+                              if op_tb_id[dep] != tbid and dep not in running_depends]
+                running_depends.update(op.depends)
+                has_dependence.update(op.depends)
                 # Expand extra dependencies into nop operations
                 if len(op.depends) > 1:
                     extra_deps = op.depends[1:]
                     op.depends = op.depends[:1]
-                    for i, dep in enumerate(extra_deps):
-                        new_ops.append(Op(Instruction.nop, -1, None, None, [dep]))
-                        op_idx[new_ops[-1]] = len(new_ops) - 1
-                        #op_tb_id[new_ops[-1]] = op_tb_id[op]
+                    for dep in extra_deps:
+                        nop = Op(Instruction.nop, -1, None, None, [dep])
+                        new_ops.append(nop)
+                        op_idx[nop] = idx
+                        idx += 1
                 new_ops.append(op)
-                op_idx[new_ops[-1]] = len(new_ops) - 1
+                op_idx[op] = idx
+                idx += 1
             tb.ops = new_ops
 
-    # Generate the XML structure
-    algo_elem = ET.Element('algo')
-    algo_elem.set('name', program.name)
-    algo_elem.set('proto', program.protocol)
-    algo_elem.set('nchannels', str(
-        1 + max(max(tb.channel for tb in gpu.threadblocks) for gpu in program.gpus)))
+    # Generate the XML
+    xml = _XmlWriter(pretty_print)
+    algo_attrs = [('name', program.name), ('proto', program.protocol),
+        ('nchannels', 1 + max(max(tb.channel for tb in gpu.threadblocks) for gpu in program.gpus))]
     if old_format:
-        algo_elem.set('nchunksperloop', str(
-            max(max(buffer_sizes[(gpu.rank, Buffer.input)], buffer_sizes[(gpu.rank, Buffer.output)]) for gpu in program.gpus)))
-    algo_elem.set('ngpus', str(len(program.gpus)))
-    algo_elem.set('coll', program.collective)
-    algo_elem.set('inplace', str(1 if program.inplace else 0))
+        algo_attrs.append(('nchunksperloop',
+            max(max(buffer_sizes[gpu.rank][Buffer.input], buffer_sizes[gpu.rank][Buffer.output]) for gpu in program.gpus)))
+    algo_attrs.append(('ngpus', len(program.gpus)))
+    algo_attrs.append(('coll', program.collective))
+    algo_attrs.append(('inplace', 1 if program.inplace else 0))
+    xml.start('algo', algo_attrs, len(program.gpus) == 0)
     for gpu in program.gpus:
-        gpu_elem = ET.SubElement(algo_elem, 'gpu')
-        gpu_elem.set('id', str(gpu.rank))
-        gpu_elem.set('i_chunks', str(buffer_sizes[(gpu.rank, Buffer.input)]))
-        gpu_elem.set('o_chunks', str(buffer_sizes[(gpu.rank, Buffer.output)]))
-        gpu_elem.set('s_chunks', str(buffer_sizes[(gpu.rank, Buffer.scratch)]))
-        for tb in gpu.threadblocks:
-            tb_elem = ET.SubElement(gpu_elem, 'tb')
-            tb_elem.set('id', str(tb_id[tb]))
-            tb_elem.set('send', str(tb.send))
-            tb_elem.set('recv', str(tb.recv))
-            tb_elem.set('chan', str(tb.channel))
+        sizes = buffer_sizes[gpu.rank]
+        xml.start('gpu', [('id', gpu.rank),
+            ('i_chunks', sizes[Buffer.input]),
+            ('o_chunks', sizes[Buffer.output]),
+            ('s_chunks', sizes[Buffer.scratch])], len(gpu.threadblocks) == 0)
+        for tbid, tb in enumerate(gpu.threadblocks):
+            xml.start('tb', [('id', tbid), ('send', tb.send), ('recv', tb.recv), ('chan', tb.channel)], len(tb.ops) == 0)
             for op in tb.ops:
-                op_elem = ET.SubElement(
-                    tb_elem, 'op' if not old_format else 'step')
-                op_elem.set('step' if not old_format else 's', str(op_idx[op]))
-                op_elem.set('type', str(op.inst))
-
                 # The NCCL backend currently wants scratch at the end of output
                 if not use_scratch:
                     if op.src.buffer == Buffer.scratch:
                         op.src.buffer = Buffer.output
-                        op.src.index += buffer_sizes[(gpu.rank, Buffer.output)]
+                        op.src.index += sizes[Buffer.output]
                     if op.dst_buffer == Buffer.scratch:
                         op.dst.buffer = Buffer.output
-                        op.dst.index += buffer_sizes[(gpu.rank, Buffer.output)]
+                        op.dst.index += sizes[Buffer.output]
 
+                assert len(op.depends) <= 1
                 if old_format:
-                    if op.src is not None:
-                        op_elem.set('srcbuf', str(op.src.buffer))
-                        op_elem.set('srcoff', str(op.src.index))
-                    else:
-                        op_elem.set('srcbuf', 'i')
-                        op_elem.set('srcoff', '-1')
-                    if op.dst is not None:
-                        op_elem.set('dstbuf', str(op.dst.buffer))
-                        op_elem.set('dstoff', str(op.dst.index))
+                    # Every attribute is always present and none of the values need escaping,
+                    # so build the whole element with a single f-string
+                    src, dst = op.src, op.dst
+                    if len(op.depends) == 1:
+                        depid, deps = op_tb_id[op.depends[0]], op_idx[op.depends[0]]
                     else:
-                        op_elem.set('dstbuf', 'o')
-                        op_elem.set('dstoff', '-1')
+                        depid, deps = -1, -1
+                    xml.element(f'<step s="{op_idx[op]}" type="{op.inst}"'
+                        f' srcbuf="{src.buffer if src is not None else "i"}" srcoff="{src.index if src is not None else -1}"'
+                        f' dstbuf="{dst.buffer if dst is not None else "o"}" dstoff="{dst.index if dst is not None else -1}"'
+                        f' cnt="{op.cnt()}" depid="{depid}" deps="{deps}" hasdep="{1 if op in has_dependence else 0}"/>')
+                    continue
+
+                op_attrs = [('step', op_idx[op]), ('type', op.inst)]
+                if op.is_send():
+                    if op.src is not None:
+                        op_attrs.append(('buf', op.src.buffer))
+                        op_attrs.append(('off', op.src.index))
                 else:
-                    if op.is_send():
-                        if op.src is not None:
-                            op_elem.set('buf', str(op.src.buffer))
-                            op_elem.set('off', str(op.src.index))
-                    else:
-                        if op.dst is not None:
-                            op_elem.set('buf', str(op.dst.buffer))
-                            op_elem.set('off', str(op.dst.index))
-                if op.cnt() > 1 or old_format:
-                    op_elem.set('cnt', str(op.cnt()))
-                assert len(op.depends) <= 1
+                    if op.dst is not None:
+                        op_attrs.append(('buf', op.dst.buffer))
+                        op_attrs.append(('off', op.dst.index))
+                if op.cnt() > 1:
+                    op_attrs.append(('cnt', op.cnt()))
                 if len(op.depends) == 1:
-                    op_elem.set('depid', str(op_tb_id[op.depends[0]]))
-                    op_elem.set('deps', str(op_idx[op.depends[0]]))
-                elif old_format:
-                    op_elem.set('depid', '-1')
-                    op_elem.set('deps', '-1')
+                    op_attrs.append(('depid', op_tb_id[op.depends[0]]))
+                    op_attrs.append(('deps', op_idx[op.depends[0]]))
                 if op in has_dependence:
-                    op_elem.set('hasdep', '1')
-                elif old_format:
-                    op_elem.set('hasdep', '0')
-
-    if pretty_print:
-        ET.indent(algo_elem, space='  ')
-    return ET.tostring(algo_elem, encoding='unicode')
+                    op_attrs.append(('hasdep', 1))
+                xml.start('op', op_attrs, True)
+            if len(tb.ops) > 0:
+                xml.end('tb')
+        if len(gpu.threadblocks) > 0:
+            xml.end('gpu')
+    if len(program.gpus) > 0:
+        xml.end('algo')
+    return xml.getvalue()
@@ -2,6 +2,7 @@
 # Licensed under the MIT License.
 
 import sys
+from collections import deque
 from sccl.language.ir import *
 
 # Check that there are no cyclic dependencies within a Rank
@@ -9,11 +10,11 @@ def check_dependency_cycles(tbs):
     for rank, rank_tbs in enumerate(tbs):
         for tbid, tb in rank_tbs.items():
             for op in tb.ops:
-                deps = op.depends
+                deps = deque(op.depends)
                 chain = [op]
                 # DFS to check for cycles
                 while len(deps) > 0:
-                    dep = deps[0]
+                    dep = deps.popleft()
                     if dep in chain:
                         print(f"Cyclic dependency in rank {rank} threadblock {tbid} at {op}")
                         for op in chain:
@@ -24,7 +25,7 @@ def check_dependency_cycles(tbs):
                         chain.append(dep)
                     else:
                         chain = [op]
-                    deps = next_depends + deps[1:]
+                    deps.extendleft(reversed(next_depends))
 
 
 # Check there are no ordering violations between threadblocks across ranks
@@ -8,23 +8,14 @@ import heapq
 from sccl.language.ir import *
 from sccl.language.passes import *
 
-# Returns whether an operation writes to a particular slot
-def writes_to_slot(op, slot):
-    # If the instruction is a copy or reduce, check to see if the destination matches the slot
-    if op.inst == Instruction.copy or op.inst == Instruction.reduce:
-        cpy_src = op.src
-        _, buffer, index = slot
-        return buffer != cpy_src.buffer or (index < cpy_src.index and index > (cpy_src.index + cpy_src.size))
-    return op.inst != Instruction.send
-
 def remove_op(op):
     for p in op.prev:
-        p.next.remove(op)
-        p.next += op.next
+        p.next.discard(op)
+        p.next.update(op.next)
 
     for n in op.next:
-        n.prev.remove(op)
-        n.prev =  op.prev.union(n.prev)
+        n.prev.discard(op)
+        n.prev.update(op.prev)
 
 def same_tb(op1, op2):
     return op1.tb == op2.tb
@@ -35,243 +26,190 @@ def same_count(op1, op2):
 def same_buf_dst(op1, op2):
     return op1.dst.buffer == op2.dst.buffer and op1.dst.index == op2.dst.index
 
+# Ops are numbered in the order they are created. Sets of ops are sorted by number wherever their
+# order reaches the generated program, so that it doesn't depend on how ops hash
+def op_num(op):
+    return op.num
+
 class RankDAG:
     def __init__(self, num_ranks, buffers):
         self.num_ranks = num_ranks
         self.buffers = buffers
         self.slots = [] # slot = (rank, buffer, index)
         self.operations = {} # slot -> operations
+        self.last_writer = {} # slot -> last op to write to the slot
+        self.slot_sinks = {} # slot -> ops on the slot that no later op on the slot follows
+        self.op_order = [] # all ops in topological order, set by convert_set_list and optimize
+        self.num_ops = 0 # number of ops created, the next op's num
+        self.scratch_buffers = {} # (rank, buffer) -> BufferSlice of each scratch buffer, set by lower_buffers
         self.tbs = [] 
         for _ in range(num_ranks):
             self.tbs.append({}) 
-        self.tb_mapping = {}
 
 
     def add_start(self, rank, buffer, index, ref):
         slot = (rank, buffer, index)
         self.slots.append(slot)
 
-        op = Op(Instruction.start, rank, ref, ref, next=set(), prev=set())
+        op = Op(Instruction.start, rank, ref, ref, next=set(), prev=set(), num=self.num_ops)
+        self.num_ops += 1
         self.operations[slot] = op
-
-    # Find the last write to happen on this slot
-    def find_last_recv(self, slot):
-        def dfs(op):
-            # Found the last operation on the slot
-            if len(op.next) == 0:
-                return writes_to_slot(op, slot), op
+        self.last_writer[slot] = op
+        self.slot_sinks[slot] = {op}
+
+    # Find the last operations on all slots in [index, index+size) that a write by op
+    # needs to happen after. op becomes the first operation of slots that haven't been used.
+    def _find_last_ops_range(self, rank, buffer, index, size, op):
+        operations = self.operations
+        slot_sinks = self.slot_sinks
+        prev_ops = set()
+        for i in range(index, index+size):
+            slot = (rank, buffer, i)
+            sinks = slot_sinks.get(slot)
+            if sinks is not None:
+                prev_ops.update(sinks) # All operations that need to happen before
             else:
-                last_recvs = False
-                # Check if any of the children is the last write
-                for o in op.next:
-                    is_last_recv, recv_op = dfs(o)
-                    if is_last_recv:
-                        return True, recv_op
-                    last_recvs = last_recvs or is_last_recv
-                # Check if we are the last write
-                if writes_to_slot(op, slot) and not last_recvs:
-                    return True, op
-                return False, op
-        
-        result, op = dfs(self.operations[slot])
-        assert result
-        return op
+                operations[slot] = op
+        return prev_ops
+
+    # Find the last writes to all slots in [index, index+size) that a read by op needs to happen after.
+    # op takes the place of the last write among the sinks of the slots.
+    def _find_last_recvs_range(self, rank, buffer, index, size, op):
+        last_writer = self.last_writer
+        slot_sinks = self.slot_sinks
+        prev_ops = set()
+        for i in range(index, index+size):
+            slot = (rank, buffer, i)
+            prev_op = last_writer[slot]
+            prev_ops.add(prev_op)
+            sinks = slot_sinks[slot]
+            sinks.discard(prev_op)
+            sinks.add(op)
+        return prev_ops
+
+    # Record op as the last write, and so the only sink, of all slots in [index, index+size)
+    def _set_last_writer(self, rank, buffer, index, size, op):
+        last_writer = self.last_writer
+        slot_sinks = self.slot_sinks
+        for i in range(index, index+size):
+            slot = (rank, buffer, i)
+            last_writer[slot] = op
+            slot_sinks[slot] = {op}
 
-    # Find the last set of operations that happened on this slot
-    # There may be multiple as sends can happen in parallel
-    def find_last_ops(self, slot):
-        frontier = [self.operations[slot]]
-        last_ops = []
-        while len(frontier) > 0:
-            op = frontier[0]
-            if len(op.next) == 0:
-                last_ops.append(op)
-            frontier = frontier[1:] + list(op.next)   
-        return last_ops
+    # Adds dependency edges from every operation in prev_ops to op
+    def _add_prev_ops(self, op, prev_ops):
+        for prev_op in prev_ops:
+            prev_op.next.add(op)
+            op.prev.add(prev_op)
+
+    def _new_op(self, inst, rank, send_ref, recv_ref, step, priority, tb, ch=-1):
+        op = Op(inst, rank, send_ref, recv_ref, chunk_step=step, priority=priority, next=set(), prev=set(), tb=tb, channel=ch,
+                num=self.num_ops)
+        self.num_ops += 1
+        return op
 
     def add_copy(self, rank, send_ref, recv_ref, step, priority, tb):
-        op = Op(Instruction.copy, rank, send_ref, recv_ref, chunk_step=step, priority=priority, next=set(), prev=set(), tb=tb)
+        op = self._new_op(Instruction.copy, rank, send_ref, recv_ref, step, priority, tb)
         dstbuffer = recv_ref.buffer
         dstindex = recv_ref.index
-        srcbuffer = send_ref.buffer
-        srcindex = send_ref.index
         size = recv_ref.size
-        prev_ops = []
 
         # Sending part of copy
-        for i in range(srcindex, srcindex+size):
-            slot = (rank, srcbuffer, i)
-            prev_op = self.find_last_recv(slot) # All operations that need to happen before
-            prev_op.next.add(op)
-            op.prev.add(prev_op)
+        self._add_prev_ops(op, self._find_last_recvs_range(rank, send_ref.buffer, send_ref.index, size, op))
 
         # Receiving part of copy
-        prev_ops = set()
-        for i in range(dstindex, dstindex+size):
-            slot = (rank, dstbuffer, i)
-            if slot in self.operations:
-                prev_op = self.find_last_ops(slot)
-                prev_ops.append(prev_op) # All operations that need to happen before
-            else:
-                self.operations[slot] = op
-
-        for prev_op in prev_ops:
-            if op not in prev_op.next:
-                prev_op.next.add(op)
-                op.prev.add(prev_op)
+        self._add_prev_ops(op, self._find_last_ops_range(rank, dstbuffer, dstindex, size, op))
+        self._set_last_writer(rank, dstbuffer, dstindex, size, op)
 
     def add_reduce(self, rank, send_ref, recv_ref, step, priority, tb):
-        op = Op(Instruction.reduce, rank, send_ref, recv_ref, chunk_step=step, priority=priority, next=set(), prev=set(), tb=tb)
+        op = self._new_op(Instruction.reduce, rank, send_ref, recv_ref, step, priority, tb)
         dstbuffer = recv_ref.buffer
         dstindex = recv_ref.index
-        srcbuffer = send_ref.buffer
-        srcindex = send_ref.index
         size = recv_ref.size
-        prev_ops = []
 
         # B
-        for i in range(srcindex, srcindex+size):
-            slot = (rank, srcbuffer, i)
-            prev_op = self.find_last_recv(slot) # All operations that need to happen before
-            prev_op.next.add(op)
-            op.prev.add(prev_op)
+        self._add_prev_ops(op, self._find_last_recvs_range(rank, send_ref.buffer, send_ref.index, size, op))
 
         # A
-        prev_ops = []
+        slot_sinks = self.slot_sinks
+        prev_ops = set()
         for i in range(dstindex, dstindex+size):
-            slot = (rank, dstbuffer, i)
-            if slot in self.operations:
-                prev_op = self.find_last_ops(slot)
-                prev_ops = prev_ops + prev_op # All operations that need to happen before
-       
-        for prev_op in prev_ops:
-            if op not in prev_op.next:
-                prev_op.next.add(op)
-                op.prev.add(prev_op)
+            sinks = slot_sinks.get((rank, dstbuffer, i))
+            if sinks is not None:
+                prev_ops.update(sinks) # All operations that need to happen before
+        self._add_prev_ops(op, prev_ops)
+        self._set_last_writer(rank, dstbuffer, dstindex, size, op)
 
     def add_send(self, rank, send_ref, recv_ref, step, priority, tb, ch):
-        op = Op(Instruction.send, rank, send_ref, recv_ref, chunk_step=step, priority=priority, next=set(), prev=set(), tb=tb, channel=ch)
-        buffer = send_ref.buffer
-        index = send_ref.index
-        size = send_ref.size
-        prev_ops = []
-        for i in range(index, index+size):
-            slot = (rank, buffer, i)
-            prev_op = self.find_last_recv(slot)
-            prev_ops.append(prev_op) # All operations that need to happen before
+        op = self._new_op(Instruction.send, rank, send_ref, recv_ref, step, priority, tb, ch)
+        self._add_prev_ops(op, self._find_last_recvs_range(rank, send_ref.buffer, send_ref.index, send_ref.size, op))
+        return op
 
-        for prev_op in prev_ops:
-            if op not in prev_op.next:
-                prev_op.next.add(op)
-                op.prev.add(prev_op)
+    def _add_recv_op(self, inst, rank, send_ref, recv_ref, step, priority, tb, ch):
+        op = self._new_op(inst, rank, send_ref, recv_ref, step, priority, tb, ch)
+        self._add_prev_ops(op, self._find_last_ops_range(rank, recv_ref.buffer, recv_ref.index, recv_ref.size, op))
+        self._set_last_writer(rank, recv_ref.buffer, recv_ref.index, recv_ref.size, op)
         return op
 
     def add_recv(self, rank, send_ref, recv_ref, step, priority, tb, ch):
-        op = Op(Instruction.recv, rank, send_ref, recv_ref, chunk_step=step, priority=priority, next=set(), prev=set(), tb=tb, channel=ch)
-        buffer = recv_ref.buffer
-        index = recv_ref.index
-        size = recv_ref.size
-
-        prev_ops = set()
-        for i in range(index, index+size):
-            slot = (rank, buffer, i)
-            if slot in self.operations:
-                slot_prev_ops = self.find_last_ops(slot) # All operations that need to happen before
-                prev_ops = prev_ops.union(slot_prev_ops)        
-            else:
-                self.operations[slot] = op
-        if len(prev_ops) > 0:
-                for prev_op in prev_ops:
-                    prev_op.next.add(op)
-                    op.prev.add(prev_op)
-        return op
+        return self._add_recv_op(Instruction.recv, rank, send_ref, recv_ref, step, priority, tb, ch)
 
     def add_recv_reduce_copy(self, rank, send_ref, recv_ref, step, priority, tb, ch):
-        op = Op(Instruction.recv_reduce_copy, rank, send_ref, recv_ref, chunk_step=step, priority=priority, next=set(), prev=set(), tb=tb, channel=ch)
-        buffer = recv_ref.buffer
-        index = recv_ref.index
-        size = recv_ref.size
-
-        prev_ops = set()
-        for i in range(index, index+size):
-            slot = (rank, buffer, i)
-            if slot in self.operations:
-                slot_prev_ops = self.find_last_ops(slot) # All operations that need to happen before
-                prev_ops = prev_ops.union(slot_prev_ops)        
-            else:
-                self.operations[slot] = op
-        if len(prev_ops) > 0:
-                for prev_op in prev_ops:
-                    prev_op.next.add(op)
-                    op.prev.add(prev_op)
-        return op
+        return self._add_recv_op(Instruction.recv_reduce_copy, rank, send_ref, recv_ref, step, priority, tb, ch)
+
+    # Orders all operations so that every operation comes after the operations in its prev.
+    # Edges only lead from an op to ops created after it, so ops are ordered by num.
+    def _topo_order(self):
+        # Collect every operation reachable from the first operation of a slot
+        ops = set(self.operations.values())
+        frontier = list(ops)
+        while len(frontier) > 0:
+            op = frontier.pop()
+            for o in op.next:
+                if o not in ops:
+                    ops.add(o)
+                    frontier.append(o)
+        return sorted(ops, key=op_num)
 
     def convert_set_list(self):
-        ops = []
-        for slot, op in self.operations.items():
-            if op.inst == Instruction.start:
-                op.next = list(op.next)
-                for o in op.next:
-                    ops.append(o)
-            elif op.inst != Instruction.copy:
-                ops.append(op)
-
-            visited = set()
-            while len(ops) > 0:
-                op = ops[0]
-                if op not in visited:
-                    visited.add(op)
-                    op.next = list(op.next)
-                    ops = ops[1:] + op.next
-                else:
-                    ops = ops[1:]
-                    
-    def optimize(self):
-        self._optimize_rrcs_rrs()
-        self._optimize_rcs()
-        
+        self.op_order = self._topo_order()
+        for op in self.op_order:
+            op.next = sorted(op.next, key=op_num)
+
     # Given the set of operations that operate over a particular slot (rank, buffer, idx) fixed
     # Try and replace operations with pipelined ops like receive copy send (rcs)
     # or receive reduce send (rrs) and receive reduce copy send (rrcs)
     # Rules:
     # recv-copy-send 
     # recv(src, sbuf, si, _, _, _ ) send(_, _, _, dst, dbuf, di) -> recv_copy_send(src, sbuf, si, dst, dbuf, di)
-    def _optimize_rcs(self):
-        for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
-                if len(op.next) == 1:
-                    next_op = op.next[0] 
-                    if op.inst == Instruction.recv and next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
-                        op.inst = Instruction.recv_copy_send
-                        op.dst = next_op.dst
-                        op.match = op.match + next_op.match
-                        remove_op(next_op)
-                frontier = frontier[1:] + op.next
-        
-    def _optimize_rrcs_rrs(self):
-        # RRC/S -> RRS
-        for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
-                if len(op.next) == 1:
-                    next_op = op.next[0]
-                    if len(next_op.next) == 1:
-                        nnext_op = next_op.next[0]
-                        if op.inst == Instruction.recv_reduce_copy and next_op.inst == Instruction.send and nnext_op.inst == Instruction.recv and same_tb(op, next_op) and same_count(op, next_op):
-                            op.inst = Instruction.recv_reduce_send
-                            op.dst = next_op.dst
-                            op.match = op.match + next_op.match
-                            remove_op(next_op)
-                    
-                    if op.inst == Instruction.recv_reduce_copy and next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op):
+    # recv-reduce-send, when the slot is overwritten by a recv right after the send
+    # recv_reduce_copy send recv -> recv_reduce_send recv
+    # recv-reduce-copy-send
+    # recv_reduce_copy send -> recv_reduce_copy_send
+    # All rules are tried in a single pass over the ops in topological order.
+    # Runs before convert_set_list so that remove_op can update next and prev as sets.
+    # Ops removed by the pass are left in op_order, which convert_set_list recomputes.
+    def optimize(self):
+        self.op_order = self._topo_order()
+        for op in self.op_order:
+            if len(op.next) != 1:
+                continue
+            next_op = next(iter(op.next))
+            if op.inst == Instruction.recv:
+                if next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
+                    op.inst = Instruction.recv_copy_send
+                    op.dst = next_op.dst
+                    op.match.extend(next_op.match)
+                    remove_op(next_op)
+            elif op.inst == Instruction.recv_reduce_copy:
+                if next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op):
+                    if len(next_op.next) == 1 and next(iter(next_op.next)).inst == Instruction.recv:
+                        op.inst = Instruction.recv_reduce_send
+                    else:
                         op.inst = Instruction.recv_reduce_copy_send
-                        op.dst = next_op.dst
-                        op.match = op.match + next_op.match
-                        remove_op(next_op)
-                frontier = frontier[1:] + op.next
+                    op.dst = next_op.dst
+                    op.match.extend(next_op.match)
+                    remove_op(next_op)
 
     def lower_pt1(self, instances):
         self.infer_dependencies()
@@ -283,50 +221,57 @@ class RankDAG:
 
 
     def infer_dependencies(self):
-        for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
-                # Dependencies for every op is the same as the ops that are stored in prev
-                # Filter out dependencies that are satisified by tbs executing ops sequentially
-                # If multiple dependent ops from the same tb keep the one that happens last
-                depends = {}
-                for dep_op in list(op.prev):
+        depends = {} # tb -> last op in tb this op depends on. Reused across ops
+        for op in self.op_order:
+            # Dependencies for every op is the same as the ops that are stored in prev
+            # Filter out dependencies that are satisified by tbs executing ops sequentially
+            # If multiple dependent ops from the same tb keep the one that happens last
+            num_prev = len(op.prev)
+            if num_prev == 0:
+                # Start ops and the first op of a slot follow nothing
+                op.depends = []
+            elif num_prev == 1:
+                # Most other ops only follow one op, which needs no filtering by tb
+                dep_op = next(iter(op.prev))
+                op.depends = [] if dep_op.inst == Instruction.start else [dep_op]
+            else:
+                depends.clear()
+                for dep_op in op.prev:
                     if dep_op.inst != Instruction.start:
                         tb = dep_op.tb
-                        if tb not in depends or dep_op.step > depends[tb].step:
+                        tb_dep = depends.get(tb)
+                        if tb_dep is None or dep_op.step > tb_dep.step:
                             depends[tb] = dep_op
-                op.depends = list(depends.values())
-                frontier = frontier[1:] + op.next
+                op.depends = sorted(depends.values(), key=op_num)
 
     # Convert local scratch buffers to index into one global scratch buffer
     def lower_chunk(self, chunk):
-        if chunk.buffer is not Buffer.input and chunk.buffer is not Buffer.output:
-            buffer = self.buffers[chunk.rank][chunk.buffer].get_buffer()
-            index = self.buffers[chunk.rank][chunk.buffer].get_global_index(chunk.index)
-            return ChunkRef(chunk.rank, buffer, index, chunk.size)
+        buf = self.scratch_buffers.get((chunk.rank, chunk.buffer))
+        if buf is not None:
+            return ChunkRef(chunk.rank, buf.get_buffer(), buf.get_global_index(chunk.index), chunk.size)
         return chunk
 
     # Assigns each scratch buffer an offset into the global scratch buffer
     def lower_buffers(self, instances):
-        for rank_buffers in self.buffers:
+        for rank, rank_buffers in enumerate(self.buffers):
             offset = 0
             for key, buf in rank_buffers.items():
                 if key is not Buffer.input and key is not Buffer.output:
                     buf.set_offset(offset)
                     offset += buf.instance_size() * instances
+                    self.scratch_buffers[(rank, key)] = buf
 
     # Preprocess the threadblocks for lowering into xml
     def lower_tbs(self):
         gpus = []
         for rank, rank_tbs in enumerate(self.instanced_tbs):
-            lowered_tbs = {}
-            for tbid, tb in rank_tbs.items():
+            lowered_tbs = []
+            for tb in rank_tbs.values():
                 for op in tb.ops:
                     op.src = self.lower_chunk(op.src)
                     op.dst = self.lower_chunk(op.dst)
-                lowered_tbs[tbid] = tb
-            gpus.append(Gpu(rank, list(lowered_tbs.values())))
+                lowered_tbs.append(tb)
+            gpus.append(Gpu(rank, lowered_tbs))
         return gpus
 
 
@@ -350,52 +295,64 @@ class RankDAG:
         def is_scratch(buffer):
             return buffer != Buffer.input and buffer != Buffer.output
 
-        def get_new_index(rank, buffer, index, size, i):
+        # Distance between instances of a buffer when they are batched
+        batched_strides = [] # rank -> buffer -> stride
+        for rank_buffers in self.buffers:
+            batched_strides.append({buffer: buf.instance_size() if is_scratch(buffer) else len(buf)
+                                    for buffer, buf in rank_buffers.items()})
+
+        # The index of a ref in instance i is base + stride * i, returns (base, stride)
+        def get_new_index(rank, buffer, index, size):
             # Scratch buffers always use batched
-            if is_scratch(buffer):
-                buf_instance_len = self.buffers[rank][buffer].instance_size()
-                return buf_instance_len * i + index
             # If this is operating on the input/output buffer then replication strategy can be either interleaved or batched
             # This is to fit with the semantics of certain collectives
-            elif interleaved:
-                return  index * instances + i * size
-            else:
-                return  len(self.buffers[rank][buffer]) * i + index
-
-        def get_instance_ref(ref):
-            iindex = get_new_index(ref.rank, ref.buffer, ref.index, ref.size, i)
-            iref = ChunkRef(ref.rank, ref.buffer, iindex, ref.size)
-            return iref
-
-        for i in range(instances):
-            # Generate all the threadblocks and ops
-            for rank, rank_tbs in enumerate(self.tbs):
-                rank_channels = self.num_channels [rank]
-                for tbid, tb in rank_tbs.items():
+            if interleaved and not is_scratch(buffer):
+                return index * instances, size
+            return index, batched_strides[rank][buffer]
+
+        def get_instance_ref(ref, index):
+            base, stride = index
+            return ChunkRef(ref.rank, ref.buffer, base + stride * i, ref.size)
+
+        # The base and stride of the refs of every op only need to be computed once for all instances
+        instance_indices = [] # rank -> tbid -> [(src index, dst index) of each op]
+        for rank_tbs in self.tbs:
+            rank_indices = {}
+            for tbid, tb in rank_tbs.items():
+                rank_indices[tbid] = [(get_new_index(op.src.rank, op.src.buffer, op.src.index, op.src.size),
+                                       get_new_index(op.dst.rank, op.dst.buffer, op.dst.index, op.dst.size))
+                                      for op in tb.ops]
+            instance_indices.append(rank_indices)
+
+        instanced_ops = {} # op -> the op in every instance, indexed by instance
+        # Generate all the threadblocks and ops
+        # Each rank's instanced threadblocks are added by instance and then tbid
+        for rank, rank_tbs in enumerate(self.tbs):
+            rank_channels = self.num_channels[rank]
+            rank_itbs = self.instanced_tbs[rank]
+            rank_indices = instance_indices[rank]
+            tb_items = list(rank_tbs.items())
+            for i in range(instances):
+                for tbid, tb in tb_items:
                     instance_channel = rank_channels * i + tb.channel
                     itb = Threadblock(instance_channel, tb.send, tb.recv)
                     itbid = tbid * instances + i
                     itb.ops = [None] * len(tb.ops)
-                    for s, op in enumerate(tb.ops):
-                        isrc = get_instance_ref(op.src)
-                        idst = get_instance_ref(op.dst)
+                    for s, (op, (isrc_index, idst_index)) in enumerate(zip(tb.ops, rank_indices[tbid])):
+                        isrc = get_instance_ref(op.src, isrc_index)
+                        idst = get_instance_ref(op.dst, idst_index)
                         idepends = [] 
                         # Note: We don't need the fill out the rest of the metadata since replication is the last optimization
                         iop = Op(op.inst, op.rank, isrc, idst, idepends, op.step, itbid) 
                         itb.ops[s] = iop
-                    self.instanced_tbs[op.rank][itbid] = itb
+                        instanced_ops.setdefault(op, []).append(iop)
+                    rank_itbs[itbid] = itb
         
         # Redo dependency analysis
-        for rank, rank_tbs in enumerate(self.tbs):
-            for tbid, tb in rank_tbs.items():
-                for i in range(instances):
-                    itbid = tbid * instances + i
-                    itb = self.instanced_tbs[rank][itbid]
-                    for op, iop in zip(tb.ops, itb.ops):
-                        iop.depends = [None] * len(op.depends)
-                        for s, dep in enumerate(op.depends):
-                            dep_tbid = dep.tb
-                            dep_itbid = dep_tbid * instances + i
-                            dep_step = dep.step
-                            iop.depends[s] = self.instanced_tbs[op.rank][dep_itbid].ops[dep_step] 
+        # An op in instance i depends on instance i of each of the original op's dependencies
+        for op, iops in instanced_ops.items():
+            if len(op.depends) > 0:
+                idep_ops = [instanced_ops[dep] for dep in op.depends]
+                for i, iop in enumerate(iops):
+                    iop.depends = [idep[i] for idep in idep_ops]
 
@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+from collections import deque
 from dataclasses import dataclass
 from enum import Enum
 import heapq
@@ -35,9 +36,9 @@ def manual_assign_tbs(rank_dag):
             visited.add(op)
             rank = op.rank
             tbid = op.tb
-            if tbid not in rank_dag.tbs[rank]:
-                rank_dag.tbs[rank][tbid] = Threadblock()
-            tb = rank_dag.tbs[rank][tbid]
+            tb = rank_dag.tbs[rank].get(tbid)
+            if tb is None:
+                tb = rank_dag.tbs[rank][tbid] = Threadblock()
             if _verify_tb_op_compatible(tb, op):
                 tb.ops.append(op)
                 tb.channel = op.channel if op.channel != -1 else 0
@@ -62,11 +63,13 @@ def _get_tb_options(mapping, send, recv, channel, num_tbs, num_channels):
     if channel == -1: # Can go on any channel that matches to send, recv
         options = []
         for ch in range(num_channels):
-            if (send, recv, ch) in mapping:
-                options.append(mapping[(send, recv, ch)])
+            tbid = mapping.get((send, recv, ch))
+            if tbid is not None:
+                options.append(tbid)
         return options
-    elif (send, recv, channel) in mapping:
-        return [mapping[(send, recv, channel)]]
+    tbid = mapping.get((send, recv, channel))
+    if tbid is not None:
+        return [tbid]
     # Double up if necessary
     else:
         options = []
@@ -94,25 +97,26 @@ def create_base_tbs(rank_dag):
         elif op.inst != Instruction.copy:
             ops.append(op)
 
-    visited = set()
-    i = 0
-    while i < len(ops):
-        op = ops[i]
-        if op not in visited:
-            visited.add(op)
-            rank = op.rank
-            s = op.dst.rank if op.is_send() else -1
-            r = op.src.rank if op.is_recv() else -1
-            channel = 0 if op.channel == -1 else op.channel
-            if op.channel >= num_channels[rank]:
-                num_channels[rank] = op.channel + 1
-
-            if (s != -1 or r != -1) and (s,r,channel) not in tb_assignments[rank]:
+    # Ops are marked when queued so that ops reachable from several ops are only queued once
+    ops = deque(dict.fromkeys(ops))
+    queued = set(ops)
+    while len(ops) > 0:
+        op = ops.popleft()
+        rank = op.rank
+        s = op.dst.rank if op.is_send() else -1
+        r = op.src.rank if op.is_recv() else -1
+        channel = 0 if op.channel == -1 else op.channel
+        if op.channel >= num_channels[rank]:
+            num_channels[rank] = op.channel + 1
+
+        if s != -1 or r != -1:
+            if tb_assignments[rank].setdefault((s,r,channel), tbid[rank]) == tbid[rank]:
                 rank_dag.tbs[rank][tbid[rank]] = Threadblock(send=s, recv=r, channel=channel)
-                tb_assignments[rank][(s,r,channel)] = tbid[rank]
                 tbid[rank] += 1
-            ops += op.next
-        i += 1
+        for o in op.next:
+            if o not in queued:
+                queued.add(o)
+                ops.append(o)
 
     rank_dag.tb_assignments = tb_assignments
     rank_dag.num_channels = num_channels
@@ -125,12 +129,10 @@ def auto_assign_tbs(rank_dag):
     current_num_tb = []
     for rank_tbs in rank_dag.tbs:
         current_num_tb.append(len(rank_tbs))
+    # Base threadblocks have dense tbids so each rank's steps can be a list indexed by tbid
     current_tb_step = []
     for rank_tbs in rank_dag.tbs:
-        tb_step = {}
-        for tbid in rank_tbs.keys():
-            tb_step[tbid] = 0
-        current_tb_step.append(tb_step)
+        current_tb_step.append([0] * len(rank_tbs))
 
     ops = []
     for slot, op in rank_dag.operations.items():
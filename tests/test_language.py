@@ -56,9 +56,7 @@ class Reduce(Collective):
 
     # Final state rank2 has a fully reduced chunk from gpus 0, 1, and 2
     def check(self, prog):
-        expected_chunk = ReduceChunk([])
-        for r in range(self.num_ranks):
-            expected_chunk = expected_chunk.reduce(Chunk(r, 0))
+        expected_chunk = ReduceChunk([Chunk(r, 0) for r in range(self.num_ranks)])
 
         correct = True
         chunk = prog.buffers[2][Buffer.input][0]
@@ -67,6 +65,16 @@ class Reduce(Collective):
             correct = False
         return correct
 
+def test_reduce_chunk_equality():
+    c1 = Chunk(1, 0).reduce(Chunk(0, 0))
+    c2 = Chunk(0, 0).reduce(Chunk(1, 0))
+    assert c1 == c2
+    assert hash(c1) == hash(c2)
+    # Comparing reduce chunks should not reorder them
+    assert c1.chunks == [Chunk(1, 0), Chunk(0, 0)]
+    assert c1 != Chunk(0, 0)
+    assert c1 != Chunk(0, 0).reduce(Chunk(2, 0))
+
 def test_send():
     num_gpus = 3
     topology = line(num_gpus)
@@ -78,6 +86,39 @@ def test_send():
         chunk(0, Buffer.input, 0).send(1, 'scratch').send(2, Buffer.output, 0)
         assert Check()
 
+def test_chunk_dag_last_writer():
+    num_gpus = 3
+    topology = line(num_gpus)
+    collective = Send(num_gpus, 1, inplace=False)
+    prgm = SCCLProgram("send", topology, collective, 1)
+    with prgm:
+        chunk(0, Buffer.input, 0).send(1, 'scratch').send(2, Buffer.output, 0)
+        chunk(0, Buffer.input, 0).send(1, 'scratch', 0)
+    start = prgm.chunk_dag.last_ops[(0, Buffer.input, 0)]
+    resend = prgm.chunk_dag.last_ops[(1, 'scratch', 0)]
+    output_send = prgm.chunk_dag.last_ops[(2, Buffer.output, 0)]
+    assert start.inst == ChunkInstruction.start
+    assert resend.prev == [start]
+    # The send to rank 2 follows the first write to rank 1's scratch buffer, not the later one
+    assert output_send.prev[0].prev == [start]
+    assert output_send.prev[0] is not resend
+    assert output_send.steps_from_start == 2
+
+def test_chunk_dag_reduce_prev():
+    num_gpus = 3
+    topology = line(num_gpus)
+    collective = Reduce(num_gpus, 2, inplace=True)
+    prgm = SCCLProgram("reduce", topology, collective, 1)
+    with prgm:
+        chunk(0, Buffer.input, 0, 2).send(1, 'scratch')
+        chunk(1, 'scratch', 0, 2).reduce(1, Buffer.input, 0)
+    send = prgm.chunk_dag.last_ops[(1, 'scratch', 0)]
+    reduce = prgm.chunk_dag.last_ops[(1, Buffer.input, 0)]
+    dst_starts = [prgm.chunk_dag.chunk_paths[Chunk(1, i, -1, i)] for i in range(2)]
+    # Each previous op appears once, in slot order with the source before the destination
+    assert reduce.prev == [send, dst_starts[0], dst_starts[1]]
+    assert send.next == [reduce]
+
 def test_reduce():
     num_gpus = 3
     topology = line(num_gpus)
@@ -100,6 +141,75 @@ def test_local_copy():
         chunk(0, Buffer.input, 0).send(2, 'scratch').send(2, Buffer.output, 0)
         assert Check()
 
+def test_local_copy_to_used_slot():
+    num_gpus = 3
+    topology = fully_connected(num_gpus)
+    collective = Send(num_gpus, 1, inplace=False)
+    prgm = SCCLProgram("cpy", topology, collective, 1)
+    with prgm:
+        c = chunk(0, Buffer.input, 0).send(2, 'scratch')
+        chunk(0, Buffer.input, 0).send(2, Buffer.output, 0)
+        # Copy over the chunk the previous send wrote
+        c.send(2, Buffer.output, 0)
+        assert Check()
+        prgm.lower()
+    copy = prgm.rank_dag.last_writer[(2, Buffer.output, 0)]
+    assert copy.inst == Instruction.copy
+    assert any(op.inst == Instruction.recv and op.dst.buffer == Buffer.output for op in copy.prev)
+
+def test_rank_dag_read_after_writes():
+    rank_dag = RankDAG(2, [{}, {}])
+    slot0 = ChunkRef(0, Buffer.input, 0, 1)
+    slot1 = ChunkRef(0, Buffer.input, 1, 1)
+    for ref in (slot0, slot1):
+        rank_dag.add_start(0, ref.buffer, ref.index, ref)
+    # Slot 0 is written twice and slot 1 once before both are read
+    first = rank_dag.add_recv(0, ChunkRef(1, Buffer.input, 0, 1), slot0, 1, 0, 0, 0)
+    second = rank_dag.add_recv(0, ChunkRef(1, Buffer.input, 1, 1), slot0, 3, 0, 1, 0)
+    third = rank_dag.add_recv(0, ChunkRef(1, Buffer.input, 2, 1), slot1, 3, 0, 2, 0)
+    send = rank_dag.add_send(0, ChunkRef(0, Buffer.input, 0, 2), ChunkRef(1, Buffer.output, 0, 2), 4, 0, 3, 0)
+    # The read follows the last write to each slot it reads and no earlier write
+    assert send.prev == {second, third}
+    assert second.prev == {first}
+
+def test_rank_dag_write_after_reads():
+    rank_dag = RankDAG(2, [{}, {}])
+    slot = ChunkRef(0, Buffer.input, 0, 1)
+    remote = ChunkRef(1, Buffer.input, 0, 1)
+    rank_dag.add_start(0, slot.buffer, slot.index, slot)
+    rank_dag.add_recv(0, remote, slot, 1, 0, 0, 0)
+    read1 = rank_dag.add_send(0, slot, remote, 2, 0, 1, 0)
+    read2 = rank_dag.add_send(0, slot, remote, 2, 0, 2, 1)
+    # The write follows every read since the last write, and not the write those reads follow
+    second = rank_dag.add_recv(0, remote, slot, 3, 0, 0, 0)
+    assert second.prev == {read1, read2}
+    read3 = rank_dag.add_send(0, slot, remote, 4, 0, 1, 0)
+    third = rank_dag.add_recv(0, remote, slot, 5, 0, 0, 0)
+    assert third.prev == {read3}
+    # Without reads since the last write, a write follows that write
+    fourth = rank_dag.add_recv(0, remote, slot, 7, 0, 0, 0)
+    assert fourth.prev == {third}
+
+def test_rank_dag_op_order():
+    num_gpus = 3
+    topology = fully_connected(num_gpus)
+    collective = Reduce(num_gpus, 2, inplace=True)
+    prgm = SCCLProgram("reduce", topology, collective, 1)
+    with prgm:
+        chunk(0, Buffer.input, 0).reduce(2, Buffer.input, 0)
+        chunk(1, Buffer.input, 0).reduce(2, Buffer.input, 0)
+        chunk(0, Buffer.input, 1).reduce(2, Buffer.input, 1)
+        chunk(2, Buffer.input, 0, 2).send(0, Buffer.input, 0)
+        chunk(2, Buffer.input, 0, 2).send(1, Buffer.input, 0)
+        prgm.lower()
+    # Ops are ordered by creation instead of by how they hash
+    order = prgm.rank_dag.op_order
+    assert [op.num for op in order] == sorted(set(op.num for op in order))
+    for op in order:
+        assert [o.num for o in op.next] == sorted(o.num for o in op.next)
+        assert [o.num for o in op.depends] == sorted(o.num for o in op.depends)
+    assert any(len(op.depends) > 1 for op in order)
+
 def test_local_reduce():
     num_gpus = 3
     topology = line(num_gpus)
@@ -128,6 +238,17 @@ def test_scratch_buffers():
         assert c.index == 3
         XML()
 
+def test_split():
+    topology = fully_connected(2)
+    collective = AllGather(2, 4, True)
+    with SCCLProgram("split", topology, collective, 1):
+        chunks = chunk(1, Buffer.input, 0, 4).split(2)
+        assert [(c.buffer, c.index, c.size) for c in chunks] == [(Buffer.output, 4, 2), (Buffer.output, 6, 2)]
+        for c in chunks:
+            c.send(0, Buffer.output, c.index)
+        chunk(0, Buffer.input, 0, 4).send(1, Buffer.output, 0)
+        assert Check()
+
 def test_allgather():
     topology = fully_connected(2)
     collective = AllGather(2, 1, True)
@@ -136,6 +257,29 @@ def test_allgather():
         chunk(1, Buffer.input, 0).send(0, Buffer.output, 1)
         assert Check()
 
+def test_buffer_index_cache():
+    class CountingAllGather(AllGather):
+        def __init__(self, num_ranks, chunk_factor, inplace):
+            AllGather.__init__(self, num_ranks, chunk_factor, inplace)
+            self.calls = {}
+
+        def get_buffer_index(self, rank, buffer, index):
+            key = (rank, buffer, index)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            return AllGather.get_buffer_index(self, rank, buffer, index)
+
+    topology = fully_connected(2)
+    collective = CountingAllGather(2, 1, True)
+    with SCCLProgram("allgather", topology, collective, 1):
+        c = chunk(0, Buffer.input, 0)
+        assert (c.buffer, c.index) == (Buffer.output, 0)
+        c.send(1, Buffer.output, 0)
+        chunk(1, Buffer.input, 0).send(0, Buffer.output, 1)
+        chunk(0, Buffer.input, 0).send(1, Buffer.output, 0)
+        assert Check()
+    # Every location is resolved by the collective once
+    assert set(collective.calls.values()) == {1}
+
 def test_reducescatter():
     topology = fully_connected(2)
     collective = ReduceScatter(2, 1, True)
@@ -155,6 +299,15 @@ def test_alltoall():
         chunk(1, Buffer.input, 1).send(1, Buffer.output, 1)
         assert Check()
 
+def test_alltoall_incorrect():
+    topology = fully_connected(2)
+    collective = AllToAll(2, 1, False)
+    with SCCLProgram("alltoall", topology, collective, 1):
+        chunk(0, Buffer.input, 0).send(0, Buffer.output, 0)
+        chunk(0, Buffer.input, 1).send(1, Buffer.output, 1)
+        chunk(1, Buffer.input, 0).send(0, Buffer.output, 1)
+        assert not Check()
+
 def test_allreduce():
     topology = fully_connected(2)
     collective = AllReduce(2, 2, True)
@@ -178,6 +331,24 @@ def test_instruction_fusion():
     assert lowered_prgm.gpus[1].threadblocks[0].ops[1].inst == Instruction.recv
     assert lowered_prgm.gpus[2].threadblocks[0].ops[0].inst == Instruction.recv_reduce_copy_send
 
+def test_dependencies_on_several_tbs():
+    topology = fully_connected(3)
+    collective = AllReduce(3, 2, True)
+    prgm = SCCLProgram("allreduce", topology, collective, 2)
+    with prgm:
+        chunk(1, Buffer.input, 0).reduce(0, Buffer.input, 0)
+        chunk(2, Buffer.input, 1).reduce(0, Buffer.input, 1)
+        chunk(0, Buffer.input, 0, 2).send(1, 'scratch', 0)
+    lowered_prgm = prgm.lower()
+    # The send reads slots last written by receives on different tbs, so it waits on both
+    sends = [op for tb in lowered_prgm.gpus[0].threadblocks for op in tb.ops if op.inst == Instruction.send]
+    assert len(sends) == 2
+    for op in sends:
+        assert [dep.inst for dep in op.depends] == [Instruction.recv_reduce_copy] * 2
+        assert op.depends[0].tb != op.depends[1].tb
+    # One nop per send carries the second dependency
+    assert ir_to_xml(lowered_prgm).count('type="nop"') == 2
+
 def test_replication():
     topology = fully_connected(2)
     collective = AllToAll(2, 1, False)